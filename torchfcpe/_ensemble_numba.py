@@ -0,0 +1,75 @@
+import numpy as np
+
+try:
+    from numba import njit
+
+    NUMBA_AVAILABLE = True
+except ImportError:
+    NUMBA_AVAILABLE = False
+
+
+if NUMBA_AVAILABLE:
+
+    @njit(cache=True)
+    def _ensemble_dp_kernel(notes, uv_penalty, uv_penalty_2, half, zero):
+        """All the scalars have the same dtype as notes, so every step is computed in that dtype"""
+        n_batch, n_frames, n_candidates = notes.shape
+        min_indices = np.empty((n_batch, n_frames), dtype=np.int64)
+        for b in range(n_batch):
+            dp_prev = np.empty_like(notes[b, 0])
+            dp_cur = np.empty_like(notes[b, 0])
+            backtrack = np.zeros((n_frames, n_candidates), dtype=np.int64)
+            # init
+            for c in range(n_candidates):
+                dp_prev[c] = uv_penalty if notes[b, 0, c] <= 0 else zero
+            # forward
+            for t in range(1, n_frames):
+                for c2 in range(n_candidates):
+                    cur_note = notes[b, t, c2]
+                    best_value = zero
+                    best_index = 0
+                    for c1 in range(n_candidates):
+                        prev_note = notes[b, t - 1, c1]
+                        if cur_note <= 0:
+                            penalty = uv_penalty
+                        elif prev_note <= 0:
+                            penalty = uv_penalty_2
+                        else:
+                            diff = prev_note - cur_note
+                            penalty = diff * diff - half
+                            if penalty < zero:
+                                penalty = zero
+                        value = dp_prev[c1] + penalty
+                        if c1 == 0 or value < best_value:
+                            best_value = value
+                            best_index = c1
+                    dp_cur[c2] = best_value
+                    backtrack[t, c2] = best_index
+                dp_prev[:] = dp_cur
+            # backtrack
+            index = 0
+            for c in range(1, n_candidates):
+                if dp_prev[c] < dp_prev[index]:
+                    index = c
+            min_indices[b, n_frames - 1] = index
+            for t in range(n_frames - 1, 0, -1):
+                index = backtrack[t, index]
+                min_indices[b, t - 1] = index
+        return min_indices
+
+
+def ensemble_dp_numba(notes, uv_penalty):
+    """Numba version of the ensemble_f0 dynamic programming, used for cpu
+
+    Args:
+        notes (np.ndarray): (B, T, C), note of each candidate f0, 0 means uv
+        uv_penalty (float): uv penalty
+
+    Returns:
+        min_indices: (B, T), np.int64, the selected candidate of each frame
+    """
+    # same dtype as the torch version, so both decode the same path
+    dtype = notes.dtype.type
+    return _ensemble_dp_kernel(
+        notes, dtype(uv_penalty), dtype(uv_penalty * 2), dtype(0.5), dtype(0)
+    )
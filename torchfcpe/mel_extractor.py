@@ -233,24 +233,62 @@ class Wav2MelModule(torch.nn.Module):
             spec (torch.Tensor): Mel spectrogram, shape=(B, T, n_mels).
         """
 
-        # resample
-        if sample_rate == self.sampling_rate:
-            audio_res = audio
-        else:
-            key_str = str(sample_rate)
-            if key_str not in self.resample_kernel:
-                if len(self.resample_kernel) > 8:
-                    self.resample_kernel.clear()
-                self.resample_kernel[key_str] = Resample(
-                    sample_rate,
-                    self.sampling_rate,
-                    lowpass_filter_width=128
-                ).to(self.tensor_device_marker.device)
-            audio_res = self.resample_kernel[key_str](audio.squeeze(-1)).unsqueeze(-1)
+        audio_res = self.resample(audio, sample_rate)
+        n_frames = int(audio.shape[1] // self.hop_size) + 1
+        return self.extract(audio_res, n_frames, keyshift, no_cache_window=no_cache_window)
 
-        # extract
-        mel = self.mel_extractor(audio_res, keyshift, no_cache_window=no_cache_window)
+    @torch.no_grad()
+    def multi_keyshift(self,
+                       audio: torch.Tensor,  # (B, T, 1)
+                       sample_rate: [int, float],
+                       keyshifts: list = [0],
+                       no_cache_window: bool = False
+                       ) -> torch.Tensor:  # (len(keyshifts) * B, T, n_mels)
+        """
+        Get mel spectrogram of several key shifts, the resampling is done only once.
+        The mels are concatenated along the batch dim, so they can be fed to the model in one batch.
+
+        Args:
+            audio (torch.Tensor): Input waveform, shape=(B, T, 1).
+            sample_rate (int): Sampling rate.
+            keyshifts (list, optional): Key shifts. Defaults to [0].
+            no_cache_window (bool, optional): If True will clear cache. Defaults to False.
+        return:
+            spec (torch.Tensor): Mel spectrogram, shape=(len(keyshifts) * B, T, n_mels), key shift major.
+        """
+        audio_res = self.resample(audio, sample_rate)
         n_frames = int(audio.shape[1] // self.hop_size) + 1
+        return torch.cat(
+            [self.extract(audio_res, n_frames, keyshift, no_cache_window=no_cache_window) for keyshift in keyshifts],
+            0
+        )
+
+    def resample(self,
+                 audio: torch.Tensor,  # (B, T, 1)
+                 sample_rate: [int, float]
+                 ) -> torch.Tensor:  # (B, T', 1)
+        """Resample audio to self.sampling_rate"""
+        if sample_rate == self.sampling_rate:
+            return audio
+        key_str = str(sample_rate)
+        if key_str not in self.resample_kernel:
+            if len(self.resample_kernel) > 8:
+                self.resample_kernel.clear()
+            self.resample_kernel[key_str] = Resample(
+                sample_rate,
+                self.sampling_rate,
+                lowpass_filter_width=128
+            ).to(self.tensor_device_marker.device)
+        return self.resample_kernel[key_str](audio.squeeze(-1)).unsqueeze(-1)
+
+    def extract(self,
+                audio_res: torch.Tensor,  # (B, T, 1)
+                n_frames: int,
+                keyshift: [int, float] = 0,
+                no_cache_window: bool = False
+                ) -> torch.Tensor:  # (B, n_frames, n_mels)
+        """Extract mel spectrogram from resampled audio and fix it to n_frames"""
+        mel = self.mel_extractor(audio_res, keyshift, no_cache_window=no_cache_window)
         if n_frames > int(mel.shape[1]):
             mel = torch.cat((mel, mel[:, -1:, :]), 1)
         if n_frames < int(mel.shape[1]):
@@ -203,6 +203,21 @@ class CFNaiveMelPE(nn.Module):
             threshold (float): Threshold to mask. Default: 0.05.
         """
         latent = self.forward(mel)
+        return self.latent2f0(latent, decoder=decoder, threshold=threshold)
+
+    @torch.no_grad()
+    def latent2f0(self,
+                  latent: torch.Tensor,
+                  decoder: str = "local_argmax",  # "argmax" or "local_argmax"
+                  threshold: float = 0.05,
+                  ) -> torch.Tensor:
+        """
+        Decode latent to f0.
+        Args:
+            latent (torch.Tensor): Latent, shape (B, T, out_dims).
+            decoder (str): Decoder type. Default: "local_argmax".
+            threshold (float): Threshold to mask. Default: 0.05.
+        """
         if decoder == "argmax":
             cents = self.latent2cents_decoder(latent, threshold=threshold)
         elif decoder == "local_argmax":
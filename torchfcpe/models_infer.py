@@ -1,9 +1,13 @@
 import json
+import math
 import pathlib
+from typing import Tuple
 
 import torch
 from einops import rearrange
+from torch.nn.utils import parametrize
 from torchfcpe.f02midi.transpose import f02midi
+from ._ensemble_numba import NUMBA_AVAILABLE, ensemble_dp_numba
 from .models import CFNaiveMelPE
 from .tools import (
     DotDict,
@@ -16,86 +20,125 @@ from .tools import (
 from .torch_interp import batch_interp_with_replacement_detach
 
 
-def ensemble_f0(f0s, key_shift_list, tta_uv_penalty):
+def _jit_script(fn):
+    """torch.jit.script fn at the first call instead of at import, so importing torchfcpe stays quiet and fast"""
+    scripted = _jit_script_cache.get(fn.__name__)
+    if scripted is None:
+        scripted = torch.jit.script(fn)
+        _jit_script_cache[fn.__name__] = scripted
+    return scripted
+
+
+_jit_script_cache = {}
+
+
+def _ensemble_dp(notes: torch.Tensor, uv_penalty: float) -> Tuple[torch.Tensor, torch.Tensor]:
+    """Dynamic programming part of ensemble_f0
+
+    Args:
+        notes (torch.Tensor): (B, T, C), note of each candidate f0, 0 means uv
+        uv_penalty (float): uv penalty
+
+    Returns:
+        dp: (T, B, C), float, time major
+        backtrack: (T, B, C), int64, time major
+    """
+    # 按时间维优先排列，使每一帧的读写都是连续内存
+    notes = notes.transpose(0, 1).contiguous()  # (T, B, C)
+    # dp[t,b,c]表示，对于样本b，0到第t帧的所有选择中，选择第c个f0作为第t帧的结尾的最小惩罚
+    dp = torch.zeros_like(notes)
+    # backtrack[t,b,c]表示，对于样本b，0到第t帧的所有选择中，选择第c个f0作为第t帧的结尾时，t-1帧结尾的选择，值域为0到len(f0_list)-1
+    backtrack = torch.zeros(notes.shape, dtype=torch.int64, device=notes.device)
+    uv_penalty_2 = uv_penalty * 2
+    # init
+    dp[0] = (notes[0] <= 0).to(notes.dtype) * uv_penalty
+    # forward
+    for t in range(1, notes.size(0)):
+        # [b,c1,c2]表示第b个样本中，t-1帧选择c1，t帧选择c2的惩罚
+        prev = dp[t - 1]  # (B, C_prev)
+        prev_note = notes[t - 1]  # (B, C_prev)
+        cur_note = notes[t]  # (B, C_cur)
+        is_voiced_prev = (prev_note > 0).unsqueeze(2)  # (B, C_prev, 1)
+        is_voiced_cur = (cur_note > 0).unsqueeze(1)  # (B, 1, C_cur)
+
+        # t-1帧和t帧都是v的情况，L2距离小于0.5时忽略不计
+        diff = prev_note.unsqueeze(2) - cur_note.unsqueeze(1)
+        l2 = diff.mul_(diff).sub_(0.5).clamp_(min=0)
+
+        # t帧是uv的情况惩罚uv_penalty，t-1帧是uv而t帧是v的情况惩罚uv_penalty * 2
+        penalty = torch.where(
+            is_voiced_cur,
+            torch.where(is_voiced_prev, l2, uv_penalty_2),
+            uv_penalty,
+        )
+
+        # 选择最小惩罚
+        min_value, min_indices = torch.min(prev.unsqueeze(2) + penalty, dim=1)
+        dp[t] = min_value
+        backtrack[t] = min_indices
+
+    return dp, backtrack
+
+
+def _ensemble_backtrack(dp: torch.Tensor, backtrack: torch.Tensor) -> torch.Tensor:
+    """Backtracking part of ensemble_f0
+
+    Args:
+        dp (torch.Tensor): (T, B, C), output of _ensemble_dp
+        backtrack (torch.Tensor): (T, B, C), output of _ensemble_dp
+
+    Returns:
+        min_indices: (B, T), int64, the selected candidate of each frame
+    """
+    # 回溯有前后依赖，只能沿T顺序进行，但每一步在batch维上用gather并行
+    min_indices = torch.empty(
+        [dp.size(0), dp.size(1)], dtype=torch.int64, device=dp.device
+    )  # (T, B)
+    min_indices[-1] = torch.argmin(dp[-1], dim=-1)
+    for t in range(dp.size(0) - 1, 0, -1):
+        min_indices[t - 1] = backtrack[t].gather(1, min_indices[t].unsqueeze(1)).squeeze(1)
+    return min_indices.transpose(0, 1).contiguous()
+
+
+def ensemble_f0(f0s, key_shift_list, tta_uv_penalty, use_numba=False):
     """_summary_
 
     Args:
         f0s (torch.Tensor): (B, T, len(key_shift_list))
         key_shift_list (list): list of key shifts
         tta_uv_penalty (float,int): uv penalty
+        use_numba (bool): use the numba dp for cpu tensors, need numba installed. Default: False
 
     Returns:
         f0: (B, T, 1)
     """
     device = f0s.device
     # convert f0 to note
-    f0s = f0s / (
-        torch.pow(
-            2,
-            torch.tensor(key_shift_list, device=device)
-            .to(device)
-            .unsqueeze(0)
-            .unsqueeze(0)
-            / 12,
-        )
-    )
-    notes = torch.log2(f0s / 440) * 12 + 69
-    notes[notes < 0] = 0
+    key_shifts = torch.tensor(key_shift_list, device=device, dtype=f0s.dtype)
+    f0s = f0s / (2 ** (key_shifts / 12))
+    # log2(f0 / 440) * 12 + 69, with the constant part folded
+    notes = torch.log2(f0s) * 12 + (69 - 12 * math.log2(440.0))
+    notes.clamp_(min=0)
 
     # select best note
     # 使用动态规划选择最优的音高
     # 惩罚1：uv的惩罚固定为超参数uv_penalty ** 2，v转为uv时额外惩罚两次
     # 惩罚2：相邻帧音高的L2距离（uv和v互转的过程除外），距离小于0.5时忽略不计
-    uv_penalty = tta_uv_penalty**2
-    dp = torch.zeros_like(notes, device=device)
-    # dp[b,t,c]表示，对于样本b，0到第t帧的所有选择中，选择第c个f0作为第t帧的结尾的最小惩罚
-    backtrack = torch.zeros_like(notes, device=device).long()
-    # backtrack[b,t,c]表示，对于样本b，0到第t帧的所有选择中，选择第c个f0作为第t帧的结尾时，t-1帧结尾的选择，值域为0到len(f0_list)-1
-    # init
-    dp[:, 0, :] = (notes[:, 0, :] <= 0) * uv_penalty
-    # forward
-    for t in range(1, notes.size(1)):
-        penalty = torch.zeros(
-            [notes.size(0), notes.size(2), notes.size(2)], device=device
+    uv_penalty = float(tta_uv_penalty**2)
+    if use_numba and (not NUMBA_AVAILABLE):
+        print("  [WARN] torchfcpe.models_infer.ensemble_f0: numba not found, use torch dp instead.")
+    if use_numba and NUMBA_AVAILABLE and device.type == "cpu":
+        # C很小时torch的调度开销占主导，cpu上用numba直接计算整条路径
+        min_indices = torch.from_numpy(
+            ensemble_dp_numba(notes.detach().numpy(), uv_penalty)
         )
-        # [b,c1,c2]表示第b个样本中，t-1帧选择c1，t帧选择c2的惩罚
-
-        # t帧是uv的情况
-        t_uv = notes[:, t, :] <= 0
-        penalty += uv_penalty * t_uv.unsqueeze(1)
-
-        # t帧是v的情况
-        # t-1帧也是v的情况
-        t1_uv = notes[:, t - 1, :] <= 0
-        l2 = torch.pow(
-            (notes[:, t - 1, :].unsqueeze(-1) - notes[:, t, :].unsqueeze(1))
-            * (~t1_uv).unsqueeze(-1)
-            * (~t_uv).unsqueeze(1),
-            2,
-        )
-        l2 = l2 - 0.5
-        l2 = l2 * (l2 > 0)
-        penalty += l2
-
-        # t-1帧是uv的情况，uv转v的惩罚
-        penalty += t1_uv.unsqueeze(-1) * (~t_uv).unsqueeze(1) * uv_penalty * 2
-
-        # 选择最小惩罚
-        min_value, min_indices = torch.min(
-            dp[:, t - 1, :].unsqueeze(-1) + penalty, dim=1
-        )
-        dp[:, t, :] = min_value
-        backtrack[:, t, :] = min_indices
-
-    # backtrack
-    t = f0s.size(1) - 1
-    f0_result = torch.zeros_like(f0s[:, :, 0], device=device)
-    min_indices = torch.argmin(dp[:, t, :], dim=-1)
-    for i in range(0, t + 1):
-        f0_result[:, t - i] = f0s[:, t - i, min_indices]
-        min_indices = backtrack[:, t - i, min_indices]
+    else:
+        dp, backtrack = _jit_script(_ensemble_dp)(notes, uv_penalty)
+        # backtrack
+        min_indices = _jit_script(_ensemble_backtrack)(dp, backtrack)
+    f0_result = f0s.gather(2, min_indices.unsqueeze(-1))
 
-    return f0_result.unsqueeze(-1)
+    return f0_result  # (B, T, 1)
 
 
 class InferCFNaiveMelPE(torch.nn.Module):
@@ -112,9 +155,47 @@ class InferCFNaiveMelPE(torch.nn.Module):
         self.model.load_state_dict(state_dict)
         self.model.eval()
         self.args_dict = dict(args)
+        self._args = DotDict(args)
+        # plain scalars used in hot paths
+        self._f0_min = float(args.model.f0_min)
+        self._f0_max = float(args.model.f0_max)
+        self._hop_size = int(self.wav2mel.hop_size)
+        self._sr = self.wav2mel.sampling_rate
         self.register_buffer(
             "tensor_device_marker", torch.tensor(1.0).float(), persistent=False
         )
+        self._compiled_model_infer = None
+
+    def enable_compile(self, mode: str = "reduce-overhead"):
+        """Compile the model forward with torch.compile (need torch >= 2.0).
+        wav2mel stays in eager mode. Best for fixed input length, every new length triggers a recompile.
+        Call it again after replacing self.model (e.g. after quantization).
+        NOTE: the compiled callable is stored on this module, so the module can not be pickled or deepcopied
+            after enable_compile.
+        Args:
+            mode (str): torch.compile mode. Default: "reduce-overhead".
+        """
+        if not hasattr(torch, "compile"):
+            print(
+                "  [WARN] InferCFNaiveMelPE.enable_compile: torch.compile is not available (need torch >= 2.0), use eager mode."
+            )
+            return self
+        self._compiled_model_infer = torch.compile(
+            self._model_infer, mode=mode, dynamic=False
+        )
+        return self
+
+    def _model_infer(
+        self, mels: torch.Tensor, decoder_mode: str, threshold: float, bf16: bool
+    ) -> torch.Tensor:
+        """model.infer, but with bf16 only the latent forward runs under autocast, the decoder stays in fp32"""
+        if bf16:
+            with torch.autocast("cuda", dtype=torch.bfloat16):
+                latent = self.model(mels)
+            latent = latent.float()
+        else:
+            latent = self.model(mels)
+        return self.model.latent2f0(latent, decoder=decoder_mode, threshold=threshold)
 
     def forward(
         self,
@@ -123,6 +204,7 @@ class InferCFNaiveMelPE(torch.nn.Module):
         decoder_mode: str = "local_argmax",
         threshold: float = 0.006,
         key_shifts: list = [0],
+        bf16: bool = False,
     ) -> torch.Tensor:
         """Infer
         Args:
@@ -131,19 +213,33 @@ class InferCFNaiveMelPE(torch.nn.Module):
             decoder_mode (str): Decoder type. Default: "local_argmax", support "argmax" or "local_argmax".
             threshold (float): Threshold to mask. Default: 0.006.
             key_shifts (list): Key shifts. Default: [0].
+            bf16 (bool): Run the model forward under bf16 autocast if the cuda device supports it,
+                the resample, the mel extraction and the decoder stay in fp32. Default: False.
         return: f0 (torch.Tensor): f0 Hz, shape (B, (n_sample//hop_size + 1), 1).
         """
         with torch.no_grad():
-            wav = wav.to(self.tensor_device_marker.device)
-            mels = torch.stack(
-                [self.wav2mel(wav, sr, keyshift=keyshift) for keyshift in key_shifts],
-                -1,
-            )
-            mels = rearrange(mels, "B T C K -> (B K) T C")
-            f0s = self.model.infer(mels, decoder=decoder_mode, threshold=threshold)
-            f0s = rearrange(f0s, "(B K) T 1 -> B T (K 1)", K=len(key_shifts))
+            device = self.tensor_device_marker.device
+            if wav.device != device:
+                # only a pinned host to cuda copy can be asynchronous safely,
+                # other copies (e.g. cuda to cpu) must block before the cpu reads the data
+                non_blocking = (
+                    device.type == "cuda" and wav.device.type == "cpu" and wav.is_pinned()
+                )
+                wav = wav.to(device, non_blocking=non_blocking)
+            # all key shifts in one batch, (K B) T C
+            mels = self.wav2mel.multi_keyshift(wav, sr, keyshifts=key_shifts)
+            if self._compiled_model_infer is not None:
+                model_infer = self._compiled_model_infer
+            else:
+                model_infer = self._model_infer
+            f0s = model_infer(mels, decoder_mode, threshold, bf16 and self._is_bf16_supported())
+            if self._compiled_model_infer is not None:
+                # the output of cuda graphs ("reduce-overhead") is overwritten by the next replay
+                f0s = f0s.clone()
+            f0s = rearrange(f0s, "(K B) T 1 -> B T (K 1)", K=len(key_shifts))
         return f0s  # (B, T, len(key_shifts))
 
+    @torch.no_grad()
     def infer(
         self,
         wav: torch.Tensor,
@@ -159,6 +255,8 @@ class InferCFNaiveMelPE(torch.nn.Module):
         tta_uv_penalty: float = 12.0,
         tta_key_shifts: list = [0, -12, 12],
         tta_use_origin_uv=False,
+        tta_use_numba: bool = False,
+        tta_bf16: bool = False,
     ) -> torch.Tensor or (torch.Tensor, torch.Tensor):
         """Infer
         Args:
@@ -175,55 +273,60 @@ class InferCFNaiveMelPE(torch.nn.Module):
             tta_uv_penalty (float): Test time augmentation unvoiced penalty. Default: 12.0.
             tta_key_shifts (list): Test time augmentation key shifts. Default: [0, -12, 12].
             tta_use_origin_uv (bool): Use origin uv. Default: False
+            tta_use_numba (bool): Use numba for the test time augmentation dp on cpu, need numba installed. Default: False
+            tta_bf16 (bool): Run the test time augmentation model forward in bf16 on Ampere or newer cuda devices.
+                Faster, but the f0 may deviate by some cents. Default: False
         return: f0 (torch.Tensor): f0 Hz, shape (B, (n_sample//hop_size + 1) or output_interp_target_length, 1).
             if return_uv is True, return f0, uv. the shape of uv(torch.Tensor) is like f0.
         """
         # infer
         if test_time_augmentation:
             assert len(tta_key_shifts) > 0
+            # sort a copy, do not modify the list of caller (or the default value)
+            tta_key_shifts = sorted(tta_key_shifts, key=lambda x: (x if x >= 0 else -x / 2))
             flag = 0
-            if tta_use_origin_uv:
-                if 0 not in tta_key_shifts:
-                    flag = 1
-                    tta_key_shifts.append(0)
-            tta_key_shifts.sort(key=lambda x: (x if x >= 0 else -x / 2))
-            f0s = self.__call__(wav, sr, decoder_mode, threshold, tta_key_shifts)
+            if tta_use_origin_uv and (0 not in tta_key_shifts):
+                # only used for uv, not for ensemble
+                flag = 1
+                tta_key_shifts = [0] + tta_key_shifts
+            f0s = self.__call__(wav, sr, decoder_mode, threshold, tta_key_shifts, bf16=tta_bf16)
             f0 = ensemble_f0(
                 f0s[:, :, flag:],
                 tta_key_shifts[flag:],
                 tta_uv_penalty,
+                use_numba=tta_use_numba,
             )
             if tta_use_origin_uv:
-                f0_for_uv = f0s[:, :, [0]]
+                f0_for_uv = f0s[:, :, [tta_key_shifts.index(0)]]
             else:
                 f0_for_uv = f0
         else:
             f0 = self.__call__(wav, sr, decoder_mode, threshold)
             f0_for_uv = f0
         if f0_min is None:
-            f0_min = self.args_dict["model"]["f0_min"]
-        uv = (f0_for_uv < f0_min).type(f0_for_uv.dtype)
-        f0 = f0 * (1 - uv)
+            f0_min = self._f0_min
+        uv_mask = f0_for_uv < f0_min
+        f0 = torch.where(uv_mask, torch.zeros((), device=f0.device, dtype=f0.dtype), f0)
         # interp
         if interp_uv:
             f0 = batch_interp_with_replacement_detach(
-                uv.squeeze(-1).bool(), f0.squeeze(-1)
+                uv_mask.squeeze(-1), f0.squeeze(-1)
             ).unsqueeze(-1)
         if f0_max is not None:
-            f0[f0 > f0_max] = f0_max
+            f0.clamp_(max=f0_max)
         if output_interp_target_length is not None:
-            f0 = torch.nn.functional.interpolate(
-                f0.transpose(1, 2),
-                size=int(output_interp_target_length),
-                mode="nearest",
-            ).transpose(1, 2)
+            # nearest interpolation along T with the exact floor mapping i * T // L
+            # (F.interpolate computes it in float32, so it may differ by one index on long targets)
+            target_length = int(output_interp_target_length)
+            interp_index = (
+                torch.arange(target_length, device=f0.device) * f0.size(1) // target_length
+            )
+            f0 = f0.index_select(1, interp_index)
         # if return_uv is True, interp and return uv
         if return_uv:
-            uv = torch.nn.functional.interpolate(
-                uv.transpose(1, 2),
-                size=int(output_interp_target_length),
-                mode="nearest",
-            ).transpose(1, 2)
+            uv = uv_mask.type(f0_for_uv.dtype)
+            if output_interp_target_length is not None:
+                uv = uv.index_select(1, interp_index)
             return f0, uv
         else:
             return f0
@@ -254,31 +357,37 @@ class InferCFNaiveMelPE(torch.nn.Module):
 
     def get_hop_size(self) -> int:
         """Get hop size"""
-        return DotDict(self.args_dict).mel.hop_size
+        return self._hop_size
 
     def get_hop_size_ms(self) -> float:
         """Get hop size in ms"""
-        return (
-            DotDict(self.args_dict).mel.hop_size / DotDict(self.args_dict).mel.sr * 1000
-        )
+        return self._hop_size / self._sr * 1000
 
     def get_model_sr(self) -> int:
         """Get model sample rate"""
-        return DotDict(self.args_dict).mel.sr
+        return self._sr
 
     def get_mel_config(self) -> dict:
         """Get mel config"""
-        return dict(DotDict(self.args_dict).mel)
+        return dict(self._args.mel)
 
     def get_device(self) -> str:
         """Get device"""
         return self.tensor_device_marker.device
 
+    def _is_bf16_supported(self) -> bool:
+        """Whether the device of the model is a cuda device with native bf16 (Ampere or newer)"""
+        device = self.tensor_device_marker.device
+        if device.type != "cuda":
+            return False
+        # is_bf16_supported() is also True for emulated bf16 on older gpus, which is slower than fp32
+        return torch.cuda.get_device_capability(device)[0] >= 8
+
     def get_model_f0_range(self) -> dict:
         """Get model f0 range like {'f0_min': 32.70, 'f0_max': 1975.5}"""
         return {
-            "f0_min": DotDict(self.args_dict).model.f0_min,
-            "f0_max": DotDict(self.args_dict).model.f0_max,
+            "f0_min": self._f0_min,
+            "f0_max": self._f0_max,
         }
 
 
@@ -294,17 +403,27 @@ class InferCFNaiveMelPEONNX:
         raise NotImplementedError
 
 
-def spawn_bundled_infer_model(device: str = None) -> InferCFNaiveMelPE:
+def spawn_bundled_infer_model(
+    device: str = None, quantize: bool = False, compile_model: bool = False
+) -> InferCFNaiveMelPE:
     """
     Spawn bundled infer model
     This model has been trained on our dataset and comes with the package.
     You can use it directly without anything else.
     Args:
         device (str): Device. Default: None.
+        quantize (bool): Dynamic int8 quantization of linear layers, only used on cpu. Default: False.
+        compile_model (bool): Compile the model forward with torch.compile. Default: False.
     """
     file_path = pathlib.Path(__file__)
     model_path = file_path.parent / "assets" / "fcpe_c_v001.pt"
-    model = spawn_infer_model_from_pt(str(model_path), device, bundled_model=True)
+    model = spawn_infer_model_from_pt(
+        str(model_path),
+        device,
+        bundled_model=True,
+        quantize=quantize,
+        compile_model=compile_model,
+    )
     return model
 
 
@@ -338,7 +457,11 @@ def spawn_infer_model_from_onnx(
 
 
 def spawn_infer_model_from_pt(
-    pt_path: str, device: str = None, bundled_model: bool = False
+    pt_path: str,
+    device: str = None,
+    bundled_model: bool = False,
+    quantize: bool = False,
+    compile_model: bool = False,
 ) -> InferCFNaiveMelPE:
     """
     Spawn infer model from pt file
@@ -346,6 +469,9 @@ def spawn_infer_model_from_pt(
         pt_path (str): Path to pt file.
         device (str): Device. Default: None.
         bundled_model (bool): Whether this model is bundled model, only used in spawn_bundled_infer_model.
+        quantize (bool): Dynamic int8 quantization of linear layers, only used on cpu. Default: False.
+            The quantized model can not be moved to other devices.
+        compile_model (bool): Compile the model forward with torch.compile, see InferCFNaiveMelPE.enable_compile. Default: False.
     """
     device = get_device(device, "torchfcpe.tools.spawn_infer_cf_naive_mel_pe_from_pt")
     ckpt = torch.load(pt_path, map_location=torch.device(device))
@@ -362,6 +488,19 @@ def spawn_infer_model_from_pt(
         infer_model = InferCFNaiveMelPE(args, ckpt["model"])
         infer_model = infer_model.to(device)
         infer_model.eval()
+        if quantize:
+            if device == "cpu":
+                # quantize_dynamic can not handle the weight norm of output_proj, fold it first
+                remove_weight_norm(infer_model.model.output_proj)
+                infer_model.model = torch.ao.quantization.quantize_dynamic(
+                    infer_model.model, {torch.nn.Linear}, dtype=torch.qint8
+                )
+            else:
+                print(
+                    f"  [WARN] spawn_infer_model_from_pt: quantize is only supported on cpu, but device is {device}; skip quantize."
+                )
+        if compile_model:
+            infer_model.enable_compile()
     else:
         raise ValueError(
             f"  [ERROR] args.model.type is {args.model.type}, but only support CFNaiveMelPE"
@@ -370,6 +509,15 @@ def spawn_infer_model_from_pt(
     return infer_model
 
 
+def remove_weight_norm(module: torch.nn.Module) -> torch.nn.Module:
+    """Fold the weight norm of module into a plain weight, for both versions of weight_norm in models.py"""
+    if parametrize.is_parametrized(module, "weight"):
+        parametrize.remove_parametrizations(module, "weight", leave_parametrized=True)
+    else:
+        torch.nn.utils.remove_weight_norm(module)
+    return module
+
+
 def spawn_model(args: DotDict) -> CFNaiveMelPE:
     """Spawn conformer naive model"""
     if args.model.type == "CFNaiveMelPE":